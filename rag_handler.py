@@ -1,7 +1,9 @@
 import os
 os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
 import json
-from typing import List, Dict
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional
 from dotenv import load_dotenv
 from sentence_transformers import SentenceTransformer
 from sklearn.metrics.pairwise import cosine_similarity
@@ -15,6 +17,11 @@ EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH","story_embedding_cache.n
 META_CACHE_PATH = os.getenv("META_CACHE_PATH","story_meta_cache.pkl")
 BOT_LANG = os.getenv("BOT_LANG", "CN")
 CHARACTER_NAME = os.getenv("CHARACTER_NAME", "Moka")
+# Decay and weight are blend coefficients, so keep them within [0, 1]
+RAG_CONTEXT_DECAY = min(max(float(os.getenv("RAG_CONTEXT_DECAY", 0.6)), 0.0), 1.0)
+RAG_CONTEXT_WEIGHT = min(max(float(os.getenv("RAG_CONTEXT_WEIGHT", 0.3)), 0.0), 1.0)
+RAG_STICKY_MARGIN = float(os.getenv("RAG_STICKY_MARGIN", 0.05))
+RAG_MSG_CACHE_SIZE = int(os.getenv("RAG_MSG_CACHE_SIZE", 256))
 
 g_model = None
 story_sentence_metas = []
@@ -110,11 +117,8 @@ def process_stories():
         all_embeddings_np = None
         print("No matching summary results found")
 
-def find_relevant_story(user_query: str, top_n: int = 1) -> List[Dict]:
-    """
-    Search for the most relevant story summary based on user input.
-    Return a list containing the top_n information dictionaries.
-    """
+def ensure_initialized():
+    """Make sure the model and the story embeddings are available."""
     if not story_sentence_metas or all_embeddings_np is None:
         print("Embedding not initialized, attempting to load automatically...")
         if not load_cache():
@@ -123,35 +127,158 @@ def find_relevant_story(user_query: str, top_n: int = 1) -> List[Dict]:
     if g_model is None:
         load_model_and_tokenizer()
 
+def encode_text(text: str) -> np.ndarray:
+    """Encode a single text into a L2-normalized embedding vector."""
+    if g_model is None:
+        load_model_and_tokenizer()
+    return _normalize(np.asarray(g_model.encode([text])[0], dtype=np.float32))
+
+def _normalize(vec: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+def _similarities(query_embedding: np.ndarray) -> np.ndarray:
+    return cosine_similarity(query_embedding.reshape(1, -1), all_embeddings_np)[0]
+
+def _build_result(idx: int, score: float) -> Dict:
+    meta = story_sentence_metas[idx]
+
+    # Read Summary to return full_content
+    file_path = os.path.join(STORY_DIR, meta["file_name"])
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            full_content = data.get("extractedData", "")
+    except Exception as e:
+        full_content = ""
+        print(f"Error reading {file_path}: {e}")
+
+    return {
+        "score": score,
+        **meta,
+        "full_content": full_content
+    }
+
+def find_relevant_story(user_query: str, top_n: int = 1) -> List[Dict]:
+    """
+    Search for the most relevant story summary based on user input.
+    Return a list containing the top_n information dictionaries.
+    """
+    ensure_initialized()
+
     if not story_sentence_metas:
         return []
 
     #Cosine Similarity
-    user_embedding = g_model.encode([user_query])[0]
-    sims = cosine_similarity(user_embedding.reshape(1, -1), all_embeddings_np)[0]
+    sims = _similarities(encode_text(user_query))
     sorted_indices = np.argsort(sims)[::-1]
 
     results = []
     for i in range(min(top_n, len(sorted_indices))):
         idx = sorted_indices[i]
-        meta = story_sentence_metas[idx]
+        results.append(_build_result(idx, float(sims[idx])))
+    return results
 
-        # Read Summary to return full_content
-        file_path = os.path.join(STORY_DIR, meta["file_name"])
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                full_content = data.get("extractedData", "")
-        except Exception as e:
-            full_content = ""
-            print(f"Error reading {file_path}: {e}")
+class ConversationContext:
+    """
+    Conversation-aware retrieval for one chat session.
+    Keeps a decaying running context vector built from cached per-message
+    embeddings of both user messages and replies, blends it with the current
+    query, and keeps the previous chapter (unchanged, so the prompt stays
+    stable) when a new one only wins by less than sticky_margin.
+    Each call updates the shared state atomically, but encoding and story
+    file reads run outside the lock. Concurrent turns are not serialized, so
+    a reply may be folded in after another turn's query; the context vector
+    is a rough summary and tolerates that.
+    """
+    def __init__(self, decay: float = RAG_CONTEXT_DECAY, context_weight: float = RAG_CONTEXT_WEIGHT,
+                 sticky_margin: float = RAG_STICKY_MARGIN, cache_size: int = RAG_MSG_CACHE_SIZE):
+        self.decay = decay
+        self.context_weight = context_weight
+        self.sticky_margin = sticky_margin
+        self.cache_size = cache_size
+        self._embedding_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.context_embedding: Optional[np.ndarray] = None
+        self.last_result: Optional[Dict] = None
+        self._last_idx: Optional[int] = None
+        self._lock = threading.Lock()
 
-        results.append({
-            "score": float(sims[idx]),
-            **meta,
-            "full_content": full_content
-        })
-    return results
+    def _embed(self, text: str) -> np.ndarray:
+        """Return the embedding of text, encoding it only on a cache miss."""
+        with self._lock:
+            emb = self._embedding_cache.get(text)
+            if emb is not None:
+                self._embedding_cache.move_to_end(text)
+                return emb
+        emb = encode_text(text)
+        with self._lock:
+            self._embedding_cache[text] = emb
+            if len(self._embedding_cache) > self.cache_size:
+                self._embedding_cache.popitem(last=False)
+        return emb
+
+    def add_message(self, text: str):
+        """Fold a message (e.g. a reply) into the running context vector."""
+        embedding = self._embed(text)
+        with self._lock:
+            self._add_message(embedding)
+
+    def _add_message(self, embedding: np.ndarray):
+        # Caller must hold self._lock
+        if self.context_embedding is None:
+            self.context_embedding = embedding
+        else:
+            self.context_embedding = _normalize(
+                self.decay * self.context_embedding + (1 - self.decay) * embedding
+            )
+
+    def retrieve(self, user_query: str) -> List[Dict]:
+        """
+        Return the most relevant story for user_query given the conversation so far.
+        "score" is frozen while the chapter is kept so the prompt stays identical;
+        "current_score" is this turn's similarity and "sticky" tells whether the
+        previous chapter was kept. Scores are against the blended query/context vector.
+        """
+        ensure_initialized()
+
+        if not story_sentence_metas:
+            return []
+
+        query_embedding = self._embed(user_query)
+        with self._lock:
+            context_embedding = self.context_embedding
+            last_result = self.last_result
+            last_idx = self._last_idx
+
+        blended = query_embedding
+        if context_embedding is not None and self.context_weight > 0:
+            blended = _normalize(
+                (1 - self.context_weight) * query_embedding + self.context_weight * context_embedding
+            )
+        sims = _similarities(blended)
+        idx = int(np.argmax(sims))
+
+        if (last_idx is not None and last_idx < len(story_sentence_metas)
+                and story_sentence_metas[last_idx]["file_name"] == last_result["file_name"]):
+            if idx != last_idx and sims[idx] - sims[last_idx] < self.sticky_margin:
+                idx = last_idx
+        else:
+            last_idx = None
+
+        sticky = idx == last_idx
+        if sticky:
+            # Same chapter as last turn: keep the stored result (score included) so the prompt stays identical
+            result = last_result
+        else:
+            result = _build_result(idx, float(sims[idx]))
+
+        with self._lock:
+            if not sticky:
+                self.last_result = result
+                self._last_idx = idx
+            self._add_message(query_embedding)
+
+        return [{**result, "current_score": float(sims[idx]), "sticky": sticky}]
 
 if __name__ == '__main__':
     print("Starting RAG Handler test...")
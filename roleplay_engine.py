@@ -81,6 +81,7 @@ mocha_memory = MochaMemory(
     CHARACTER_FULL_NAME=CHARACTER_FULL_NAME,
     max_rounds=50,
 )
+retrieval_context = rag_handler.ConversationContext()
 
 # Initializing RAG
 try:
@@ -99,7 +100,7 @@ def generate_reply(author_name: str, user_msg: str, iso_dt: str) -> str | None:
     """
     relevant_story_prompt = ""
     try:
-        rels = rag_handler.find_relevant_story(user_msg, top_n=1)
+        rels = retrieval_context.retrieve(user_msg)
         if rels:
             info = rels[0]
             relevant_story_prompt = (
@@ -129,6 +130,12 @@ def generate_reply(author_name: str, user_msg: str, iso_dt: str) -> str | None:
         deny = {"(NO REPLY)", "NO REPLY", "（NO REPLY）",
                 f"({CHARACTER_NAME}NO REPLY)", f"（{CHARACTER_NAME}NO REPLY）."}
 
+        if reply not in deny:
+            try:
+                retrieval_context.add_message(reply)
+            except Exception:
+                traceback.print_exc()
+
         usage = resp.usage
         tokens_prompt     = usage.prompt_tokens
         tokens_completion = usage.completion_tokens
@@ -140,7 +147,8 @@ def generate_reply(author_name: str, user_msg: str, iso_dt: str) -> str | None:
             "user_msg": user_msg,
             "rag_event": info["event_name"] if rels else None,
             "rag_chapter": info["chapter_title"] if rels else None,
-            "rag_score": info["score"] if rels else None,
+            "rag_score": info["current_score"] if rels else None,
+            "rag_sticky": info["sticky"] if rels else None,
             "rag_summary":info["Summary"] if rels else None,
             "tokens_prompt": tokens_prompt,
             "tokens_completion": tokens_completion,
@@ -149,7 +157,6 @@ def generate_reply(author_name: str, user_msg: str, iso_dt: str) -> str | None:
         }
         logger.info(json.dumps(log_obj, ensure_ascii=False))
 
-        deny = {...}
         return None if reply in deny else reply
 
     except Exception: